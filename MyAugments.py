@@ -4,14 +4,16 @@ from imgaug import augmenters as iaa
 
 # Local imports
 from helpers.augmentation import Augment
+from helpers.augmenters import opencv_gaussian_blur, opencv_rotate, numba_additive_gaussian_noise
+from helpers.gpu import gpu_gaussian_blur, gpu_affine
 
 def make_default_ops():
     return [
         Augment("Blur", iaa.Sequential([
-            iaa.GaussianBlur(sigma=(3.0, 5.0)) # Blur images with a sigma of 3.0 to 5.0
-        ]), num_repetitions=3),
+            opencv_gaussian_blur(sigma=(3.0, 5.0)) # Blur images with a sigma of 3.0 to 5.0
+        ]), num_repetitions=3, gpu_operation=gpu_gaussian_blur(sigma=(3.0, 5.0))),
         Augment("AdditiveGaussianNoise", iaa.Sequential([
-            iaa.AdditiveGaussianNoise(scale=0.05*255)
+            numba_additive_gaussian_noise(scale=0.05*255)
         ]), num_repetitions=1)
     ]
 
@@ -23,24 +25,21 @@ def make_rotation_ops(increments):
             suffix = f"Back{-increment}"
         ops.append(
             Augment("Rotate" + suffix, iaa.Sequential([
-                iaa.Grayscale(alpha=1.0),
-                iaa.Rotate(increment)
-            ]), num_repetitions=1)
+                opencv_rotate(increment)
+            ]), num_repetitions=1, grayscale=True)
         )
     return ops
 
 def make_scale_ops():
     return [
         Augment("Scale", iaa.Sequential([
-            iaa.Grayscale(alpha=1.0),
             iaa.Affine(
                 scale={"x": (0.8, 1.2), "y": (0.8, 1.2)},
                 rotate=(-5, 5)
             )
-        ]), num_repetitions=5),
+        ]), num_repetitions=5, grayscale=True, gpu_operation=gpu_affine(scale=(0.8, 1.2), rotate=(-5, 5))),
         Augment("Original", iaa.Sequential([
-            iaa.Grayscale(alpha=1.0),
-        ]), num_repetitions=1),
+        ]), num_repetitions=1, grayscale=True),
     ]
 
 #########################################################
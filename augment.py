@@ -4,20 +4,29 @@
 import time
 import os
 import argparse
+import threading
+import multiprocessing
 from shutil import copyfile
-from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # Dependency imports
 import numpy as np
+import cv2
 import imgaug as ia
 from imgaug import augmenters as iaa
 from imgaug.augmentables.bbs import BoundingBox, BoundingBoxesOnImage
 from imgaug.augmentables.batches import UnnormalizedBatch
-import imageio
+from imgaug.random import SEED_MAX_VALUE
+from imgaug.multicore import _reseed_global_local
 from tqdm import tqdm
 
 # Local imports
 from helpers.augmentation import ImageData
+from helpers.augmenters import use_serial_kernels
+from helpers.files import read_image, encode_image, mirror_file, FileFlusher
+from helpers.gpu import is_gpu_available, augment_on_gpu, seed as seed_gpu
 from MyAugments import get_augmentation_operations
 
 """
@@ -25,10 +34,170 @@ This file is for the boilerplate around image augmentation. To modify the image
 augmentation itself, modify MyAugments.py.
 """
 
+# Build the augmenter trees from MyAugments.py only once per process.
+load_augmentation_operations = lru_cache(maxsize=None)(get_augmentation_operations)
+
 class DataPair:
-    def __init__(self, data_path, image_path):
+    def __init__(self, data_path, image_path, stem, extension):
         self.data_path = data_path
         self.image_path = image_path
+        # Image filename split into name and extension, for naming outputs
+        self.stem = stem
+        self.extension = extension
+
+def load_batch_images(items):
+    """
+    Load the images for a batch. When every image has the same shape they are
+    read into one contiguous (batch size, height, width, 3) uint8 array,
+    otherwise a list of arrays is returned.
+    """
+    first_image = read_image(items[0].image_path)
+    images = np.empty((len(items),) + first_image.shape, dtype=np.uint8)
+    images[0] = first_image
+    for index, item in enumerate(items[1:], start=1):
+        image = read_image(item.image_path)
+        if image.shape != first_image.shape:
+            # Mixed sizes can't share a buffer
+            return list(images[:index]) + [image] + [read_image(item.image_path) for item in items[index + 1:]]
+        images[index] = image
+    return images
+
+def repeat_batches(batches, num_repetitions):
+    """
+    Yield every batch once per repetition. Each yielded batch's data is
+    tagged with its repetition index as `(repetition_index, data)`.
+    """
+    for repetition_index in range(num_repetitions):
+        for batch in batches:
+            yield UnnormalizedBatch(
+                images=batch.images_unaug,
+                bounding_boxes=batch.bounding_boxes_unaug,
+                data=(repetition_index, batch.data))
+
+# Augmenters of every op, set in each worker process of an `OpPool`.
+_worker_operations = None
+
+def _initialize_op_pool_worker(operations):
+    global _worker_operations
+    # Like imgaug's own Pool: the pool already runs one process per core.
+    cv2.setNumThreads(0)
+    use_serial_kernels()
+    _worker_operations = operations
+    for operation in operations:
+        operation.localize_random_state_()
+
+def _augment_op_batch(inputs):
+    op_index, seed, batch = inputs
+    operation = _worker_operations[op_index]
+    # Same reseeding as imgaug's Pool(seed=...) does for each batch
+    _reseed_global_local(seed, operation)
+    return operation.augment_batch_(batch)
+
+class OpPool:
+    """
+    One pool of worker processes shared by every op, so the pool only
+    starts once per run instead of once per op. Each worker receives all
+    the ops' augmenters up front and then `(op index, seed, batch)` per batch.
+
+    Parameters
+    ----------
+    operations : [imgaug.augmenters.Augmenter]
+        The `operation` of every op, in op order.
+    processes : int
+        Number of worker processes.
+    """
+    def __init__(self, operations, processes):
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes, initializer=_initialize_op_pool_worker, initargs=(operations,))
+
+    def imap_batches(self, op_index, batches, seed):
+        """
+        Augment batches with the op at `op_index`, yielding results in order.
+        Each batch is augmented with a seed derived from `seed` and the
+        batch's position, so results are reproducible no matter which
+        worker picks a batch up.
+        """
+        # Bound how far batch loading runs ahead of the consumer
+        output_buffer_left = threading.Semaphore(self.processes * 10)
+        stopped = False
+
+        def inputs():
+            for batch_index, batch in enumerate(batches):
+                output_buffer_left.acquire()
+                if stopped:
+                    return
+                yield op_index, seed + batch_index, batch
+
+        try:
+            for batch in self._pool.imap(_augment_op_batch, inputs()):
+                output_buffer_left.release()
+                yield batch
+        finally:
+            # Unblock the pool's task feeder if the consumer stopped early
+            stopped = True
+            output_buffer_left.release()
+
+    def close(self, terminate=False):
+        """
+        Stop the worker processes. Pending batches are dropped when `terminate` is set.
+        """
+        if terminate:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
+
+def augment_batches_on_gpu(op, batches):
+    """
+    Like `augment_batches`, but runs `op.gpu_operation` on the GPU. Batches
+    with mixed image sizes can't be stacked into one tensor and are
+    augmented by `op.operation` on the CPU instead.
+    """
+    for batch in batches:
+        if not isinstance(batch.images_unaug, np.ndarray):
+            yield from op.operation.augment_batches([batch])
+            continue
+        batch.images_aug, batch.bounding_boxes_aug = augment_on_gpu(op.gpu_operation, batch.images_unaug, batch.bounding_boxes_unaug)
+        yield batch
+
+def to_grayscale_batches(batches):
+    """
+    Convert every image in the batches to single channel grayscale.
+    Grayscale ops then only move a third of the bytes through imgaug.
+    """
+    grayscale_batches = []
+    for batch in batches:
+        if isinstance(batch.images_unaug, np.ndarray):
+            images = np.empty(batch.images_unaug.shape[:3] + (1,), dtype=np.uint8)
+        else:
+            images = [None] * len(batch.images_unaug)
+        bounding_boxes = []
+        for index, (image, bbs) in enumerate(zip(batch.images_unaug, batch.bounding_boxes_unaug)):
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)[:, :, None]
+            images[index] = gray
+            bounding_boxes.append(bbs.deepcopy(shape=gray.shape))
+        grayscale_batches.append(UnnormalizedBatch(images=images, bounding_boxes=bounding_boxes, data=batch.data))
+    return grayscale_batches
+
+def write_augmented_image(image, bbs, data, op, repetition_index, class_to_id, output_prefix, flusher):
+    """
+    Encode an augmented image and its matching YOLO data file, and queue both
+    on `flusher` to be written to the output directory.
+    `output_prefix` is the output directory path ending in a path separator.
+    """
+    # Determine base path for image and matching data file
+    if op.num_repetitions == 1:
+        base_path = f"{output_prefix}{data.stem}_{op.name}"
+    else:
+        base_path = f"{output_prefix}{data.stem}_{op.name}_rep{repetition_index}"
+
+    # Encode image in memory and queue it for the output folder
+    flusher.put(f"{base_path}{data.extension}", encode_image(image, data.extension))
+
+    # Queue modified imgaug bounding boxes as YOLO format for the output folder
+    image_height, image_width, _ = image.shape
+    output_data = ImageData.from_imagaug(image_width, image_height, bbs)
+    flusher.put(f"{base_path}.txt", output_data.to_yolo(class_to_id))
 
 def main():
     # Configure imgaug
@@ -49,6 +218,8 @@ def main():
         help='Show previews instead of writing to disk')
     parser.add_argument('--skip_originals', action='store_true', 
         help='Prevent original images from being copied into the destination folder')
+    parser.add_argument('--gpu', action='store_true', 
+        help='Run augmentations that have a GPU equivalent on a CUDA GPU')
 
     args = parser.parse_args()
 
@@ -57,6 +228,13 @@ def main():
     user_requested_preview_only = args.preview_only
     single_threaded = args.single_threaded
     skip_originals = args.skip_originals
+    use_gpu = args.gpu
+
+    if use_gpu and not is_gpu_available():
+        print("No CUDA GPU or kornia install found, augmenting on the CPU instead.")
+        use_gpu = False
+    if use_gpu:
+        seed_gpu(1)
 
     #########################################################
     # Process all data files in the input directory, either 
@@ -68,6 +246,7 @@ def main():
     class_names = []
     with open(os.path.join(input_directory, "class.names")) as class_file:
         class_names = [line.rstrip() for line in class_file if line.rstrip() != ""]
+    class_to_id = {name: index for index, name in enumerate(class_names)}
 
     if not user_requested_preview_only:
         # Copy MyAugments.py to the output directory
@@ -77,53 +256,38 @@ def main():
 
     augment_files = []
 
-    filenames = os.listdir(input_directory)
-    filenames.sort()
-    for filename in filenames:
-
-        # Work only on YOLO .txt files.
-        if not filename.endswith(".txt"):
-            continue
-
-        base_filename = os.path.splitext(filename)[0]
-        data_path = os.path.join(input_directory, base_filename + ".txt")
-        image_path = os.path.join(input_directory, base_filename + ".jpg")
-        augment_files.append(DataPair(data_path, image_path))
+    # Work only on YOLO .txt files. DirEntry already carries the full path.
+    entries = sorted((entry for entry in os.scandir(input_directory) if entry.name.endswith(".txt")), key=lambda entry: entry.name)
+    for entry in entries:
+        base_filename = entry.name[:-len(".txt")]
+        data_path = entry.path
+        image_path = entry.path[:-len(".txt")] + ".jpg"
+        augment_files.append(DataPair(data_path, image_path, base_filename, ".jpg"))
 
         if not skip_originals and not user_requested_preview_only:
-            # Copy the original data file to the output directory.
-            copyfile(
-                os.path.join(input_directory, base_filename + ".txt"),
-                os.path.join(output_directory, base_filename + ".txt"))
-            # Copy the original image to the output directory.
-            copyfile(
-                os.path.join(input_directory, base_filename + ".jpg"),
-                os.path.join(output_directory, base_filename + ".jpg"))
+            # Mirror the original data file to the output directory.
+            mirror_file(data_path, os.path.join(output_directory, base_filename + ".txt"))
+            # Mirror the original image to the output directory.
+            mirror_file(image_path, os.path.join(output_directory, base_filename + ".jpg"))
 
     #########################################################
     # From the list of data/image pairs to augment, create
     # batches for imgaug to process.
     #########################################################
 
-    batch = []
     batches = []
     MAX_BATCH_SIZE = 10 if user_requested_preview_only else 16
 
-    for i, item in enumerate(augment_files):
-        # Load image into memory
-        image = imageio.imread(item.image_path)
+    for batch_start in range(0, len(augment_files), MAX_BATCH_SIZE):
+        items = augment_files[batch_start:batch_start + MAX_BATCH_SIZE]
+        # Load images into memory
+        images = load_batch_images(items)
         # Get imgaug representation of bounding boxes
-        image_data = ImageData.from_yolo_data(item.data_path, class_names)
-        bbs = image_data.to_imgaug(image.shape)
-        
-        batch.append((image, bbs, item))
-        
-        # If we're at the max batch size or the end of the file list,
-        # finalize the batch and add it to the batch list. 
-        if len(batch) == MAX_BATCH_SIZE or i == len(augment_files) - 1:
-            images, bounding_boxes, data = list(zip(*batch))
-            batches.append(UnnormalizedBatch(images=images, bounding_boxes=bounding_boxes, data=data))
-            batch.clear()
+        bounding_boxes = [
+            ImageData.from_yolo_data(item.data_path, class_names).to_imgaug(image.shape)
+            for item, image in zip(items, images)
+        ]
+        batches.append(UnnormalizedBatch(images=images, bounding_boxes=bounding_boxes, data=tuple(items)))
 
     #########################################################
     # Apply each operation in MyAugments.py to each image
@@ -131,53 +295,83 @@ def main():
 
     should_multithread = not single_threaded and not user_requested_preview_only
 
-    ops = get_augmentation_operations()
+    ops = load_augmentation_operations()
 
-    total_ops_per_image = sum([op.num_repetitions for op in ops])
-    input_image_count = sum([len(b.data) for b in batches])
+    # Convert to grayscale once for all ops that want grayscale input.
+    grayscale_batches = to_grayscale_batches(batches) if any(op.grayscale for op in ops) else []
+
+    total_ops_per_image = sum(op.num_repetitions for op in ops)
+    input_image_count = len(augment_files)
     generated_image_count = total_ops_per_image * input_image_count
     print(f"{generated_image_count} new images will be created.")
     progress_bar = tqdm(total=generated_image_count)
 
-    for op in ops:
-        for i in range (op.num_repetitions):
-            # Produce augmentations
-            for batches_aug in op.operation.augment_batches(batches, background=should_multithread):
+    output_prefix = os.path.join(output_directory, "")
+    # Encoding runs on the thread pool; one flusher thread does the file writes.
+    writer = ThreadPoolExecutor(max_workers=os.cpu_count())
+    flusher = FileFlusher()
+    # Oldest first. Capped so augmented images can't pile up in memory
+    # faster than they are written.
+    write_futures = deque()
+    max_pending_writes = os.cpu_count() * 4
+
+    # Give every op its own independent, reproducible random stream.
+    op_seeds = [int(child.generate_state(1)[0] % SEED_MAX_VALUE) for child in np.random.SeedSequence(1).spawn(len(ops))]
+
+    # All ops share one pool of worker processes.
+    op_pool = OpPool([op.operation for op in ops], os.cpu_count()) if should_multithread else None
+    completed = False
+
+    try:
+        for op_index, (op, op_seed) in enumerate(zip(ops, op_seeds)):
+            op_batches = grayscale_batches if op.grayscale else batches
+
+            # Produce augmentations for every repetition in a single pass.
+            repeated_batches = repeat_batches(op_batches, op.num_repetitions)
+            if use_gpu and op.gpu_operation is not None:
+                augmented_batches = augment_batches_on_gpu(op, repeated_batches)
+            elif should_multithread:
+                augmented_batches = op_pool.imap_batches(op_index, repeated_batches, op_seed)
+            else:
+                op.operation.seed_(op_seed)
+                augmented_batches = op.operation.augment_batches(repeated_batches)
+
+            for batches_aug in augmented_batches:
+                i, batch_data = batches_aug.data
+
                 if user_requested_preview_only:
                     # Preview output one batch at a time.
                     # Blocks execution until the window is closed.
                     # Closing a window will cause the next batch to appear.
                     # Close the Python instance in the dock to stop execution.
-                    images_with_labels = [bb.draw_on_image(image) for image, bb in zip(batches_aug.images_aug, batches_aug.bounding_boxes_aug)]
+                    images = [np.repeat(image, 3, axis=2) if image.shape[2] == 1 else image for image in batches_aug.images_aug]
+                    images_with_labels = [bb.draw_on_image(image) for image, bb in zip(images, batches_aug.bounding_boxes_aug)]
                     grid_image = ia.draw_grid(images_with_labels, cols=None, rows=None)
                     title = f"{op.name}\nRep {i}\n"
-                    # title += ", ".join([item.image_filename for item in batches_aug.data])  # Draw image filenames
+                    # title += ", ".join([item.image_filename for item in batch_data])  # Draw image filenames
                     grid_image = ia.draw_text(grid_image, 8, 8, title, color=(255, 0, 0), size=50)
                     ia.imshow(grid_image, backend='matplotlib')
                     continue
 
-                for image, bbs, data in zip(batches_aug.images_aug, batches_aug.bounding_boxes_aug, batches_aug.data):
-                    # Write image and matching data file to output folder
-
-                    # Determine base name for image and matching data file
-                    image_filename_no_extension, image_extension = os.path.splitext(Path(data.image_path).name)
-                    base_filename = ""
-                    if op.num_repetitions == 1:
-                        base_filename = f"{image_filename_no_extension}_{op.name}"
-                    else:
-                        base_filename = f"{image_filename_no_extension}_{op.name}_rep{i}"
-
-                    # Write image to output folder
-                    output_image_path = os.path.join(output_directory, f"{base_filename}{image_extension}")
-                    imageio.imwrite(output_image_path, image)
-
-                    # Write modified imgaug bounding boxes as YOLO format in output folder
-                    image_height, image_width, _ = image.shape
-                    output_data = ImageData.from_imagaug(image_width, image_height, bbs)
-                    output_data.write_yolo(data.data_path, class_names)
-
-                    # Update progress bar
-                    progress_bar.update(1)
+                for image, bbs, data in zip(batches_aug.images_aug, batches_aug.bounding_boxes_aug, batch_data):
+                    # Hand the write off so disk I/O overlaps with the next batch.
+                    future = writer.submit(write_augmented_image, image, bbs, data, op, i, class_to_id, output_prefix, flusher)
+                    future.add_done_callback(lambda _: progress_bar.update(1))
+                    write_futures.append(future)
+                    if len(write_futures) > max_pending_writes:
+                        # Also surfaces any exception raised while writing.
+                        write_futures.popleft().result()
+
+        # Surface any exceptions raised while writing.
+        for future in write_futures:
+            future.result()
+        completed = True
+    finally:
+        if op_pool is not None:
+            op_pool.close(terminate=not completed)
+        # Write whatever was already queued, even if a write failed.
+        writer.shutdown(wait=True)
+        flusher.close()
     progress_bar.close()
 
 if __name__ == '__main__': # Need to do this or multithreading fails.
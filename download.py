@@ -4,19 +4,64 @@
 import os
 import time
 import math
-import urllib.request as request
-from multiprocessing.pool import ThreadPool
+import asyncio
 import argparse
 from collections import OrderedDict
 
 # Dependency Imports
+import aiohttp
+import orjson
 from tqdm import tqdm
 from azure.cognitiveservices.vision.customvision.training import CustomVisionTrainingClient
 from msrest.authentication import ApiKeyCredentials
 
+# Local imports
+from helpers.files import write_file
+
 download_batch_size = 256  # Limited to 256 by Custom Vision. See docs for CustomVisionTrainingClientOperationsMixin.get_tagged_images
+max_concurrent_downloads = 64
+download_attempts = 3
+download_chunk_size = 64 * 1024
+file_buffer_size = 1 << 20  # Per download, so up to max_concurrent_downloads of these are live at once
+# REST API version used by the Custom Vision training client.
+training_api_version = "v3.3"
+
+async def download_url(session, semaphore, url, path):
+    """
+    Stream the file at `url` to `path` in chunks, retrying failed requests with backoff.
+    File I/O runs on the default executor so it doesn't stall the other downloads.
+    Chunks collect in a `file_buffer_size` write buffer, so a typical image
+    reaches the disk in a single write when the file is closed, and no
+    fsync is issued.
+    """
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(download_attempts):
+            try:
+                async with session.get(url, raise_for_status=True) as response:
+                    file = await loop.run_in_executor(None, lambda: open(path, "wb", buffering=file_buffer_size))
+                    try:
+                        async for chunk in response.content.iter_chunked(download_chunk_size):
+                            await loop.run_in_executor(None, file.write, chunk)
+                    finally:
+                        await loop.run_in_executor(None, file.close)
+                return
+            except aiohttp.ClientError:
+                if attempt == download_attempts - 1:
+                    raise
+                await asyncio.sleep(0.2 * (2 ** attempt))
+
+async def fetch_tagged_images(session, url, training_key, skip):
+    """
+    Fetch one page of tagged image metadata straight from the Custom Vision
+    REST API, as plain dicts parsed with orjson. This skips msrest's model
+    deserialization, which is slow for full 256 image pages.
+    """
+    params = {"take": download_batch_size, "skip": skip}
+    async with session.get(url, params=params, headers={"Training-Key": training_key}, raise_for_status=True) as response:
+        return orjson.loads(await response.read())
 
-def main():
+async def main():
     # Parse arguments
     parser = argparse.ArgumentParser(description='Fetch data from CustomVision. Grab endpoint, training_key and project_id from https://www.customvision.ai/projects/<project_id>#/settings')
     parser.add_argument('--endpoint', type=str, 
@@ -38,48 +83,66 @@ def main():
     # Prepare for Custom Vision download
     credentials = ApiKeyCredentials(in_headers={"Training-key": training_key})
     trainer = CustomVisionTrainingClient(endpoint, credentials)
-    unique_tags = []
+    # Tag name to class index, in order of first appearance
+    unique_tags = {}
 
     image_count = trainer.get_tagged_image_count(project_id=project_id)
     progress_bar = tqdm(total=image_count)
 
     num_batches = math.ceil(image_count / download_batch_size)
+    # Output directory path ending in a path separator, for naming output files
+    output_prefix = os.path.join(download_directory, "")
     print(f"There will be {num_batches} batches downloaded ({image_count} images in total).")
 
-    for batch_index in range(num_batches):
-        image_batch = trainer.get_tagged_images(project_id=project_id, take=download_batch_size, skip=batch_index * download_batch_size)
-        image_urls = []
-
-        for index, image in enumerate(image_batch):
-            base_filename = str((batch_index * download_batch_size) + index)
-
-            lines = []
-            for region in image.regions:
-                # Register tag in unique_tags
-                if region.tag_name not in unique_tags:
-                    unique_tags.append(region.tag_name)
-                # Get index of region tag in unique_tags
-                tag_index = unique_tags.index(region.tag_name)
-                # Construct YOLO line (format is "<object-class> <x-center> <y-center> <width> <height>", all numbers normalized between 0 and 1)
-                line = f"{tag_index} {region.left + (region.width / 2)} {region.top  + (region.height / 2)} {region.width} {region.height}"
-                lines.append(line)
-    
-            # Create data file
-            data_filename = base_filename + ".txt"
-            with open(os.path.join(download_directory, data_filename), "w+") as data_file:
-                data_file.write("\n".join(lines))
-
-            # Queue image URL for download
-            image_download_url = image.original_image_uri
-            image_destination_path = os.path.join(download_directory, base_filename + ".jpg")
-            image_urls.append((image_download_url, image_destination_path))
-
-        def download_url(data):
-            request.urlretrieve(url=data[0], filename=data[1])
-            progress_bar.update(1)
+    loop = asyncio.get_running_loop()
+
+    tagged_images_url = f"{endpoint.rstrip('/')}/customvision/{training_api_version}/training/projects/{project_id}/images/tagged"
+
+    def fetch_image_batch(session, batch_index):
+        return asyncio.ensure_future(fetch_tagged_images(session, tagged_images_url, training_key, batch_index * download_batch_size))
+
+    semaphore = asyncio.Semaphore(max_concurrent_downloads)
+    connector = aiohttp.TCPConnector(limit=max_concurrent_downloads, limit_per_host=max_concurrent_downloads, keepalive_timeout=85)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        next_image_batch = fetch_image_batch(session, 0) if num_batches > 0 else None
+
+        for batch_index in range(num_batches):
+            image_batch = await next_image_batch
+            # Fetch the next batch's metadata while this batch downloads
+            if batch_index + 1 < num_batches:
+                next_image_batch = fetch_image_batch(session, batch_index + 1)
+            image_urls = []
+            label_payloads = []
+
+            for index, image in enumerate(image_batch):
+                base_filename = str((batch_index * download_batch_size) + index)
+
+                lines = []
+                for region in image.get("regions") or ():
+                    tag_name = region["tagName"]
+                    left, top, width, height = region["left"], region["top"], region["width"], region["height"]
+                    # Get index of region tag, registering it in unique_tags if new
+                    tag_index = unique_tags.get(tag_name)
+                    if tag_index is None:
+                        tag_index = len(unique_tags)
+                        unique_tags[tag_name] = tag_index
+                    # Construct YOLO line (format is "<object-class> <x-center> <y-center> <width> <height>", all numbers normalized between 0 and 1)
+                    line = f"{tag_index} {left + (width / 2)} {top  + (height / 2)} {width} {height}"
+                    lines.append(line)
         
-        # Download all image files in the batch simultaneously
-        ThreadPool(download_batch_size).map(download_url, image_urls)
+                # Queue data file contents to be written with the downloads
+                label_payloads.append((f"{output_prefix}{base_filename}.txt", "\n".join(lines).encode("ascii")))
+
+                # Queue image URL for download
+                image_download_url = image["originalImageUri"]
+                image_destination_path = f"{output_prefix}{base_filename}.jpg"
+                image_urls.append((image_download_url, image_destination_path))
+
+            # Write the batch's data files on the default executor while all
+            # image files in the batch download over the shared session
+            label_writes = [loop.run_in_executor(None, write_file, path, payload) for path, payload in label_payloads]
+            await asyncio.gather(*label_writes, *(download_url(session, semaphore, url, path) for url, path in image_urls))
+            progress_bar.update(len(image_urls))
 
     progress_bar.close()
     
@@ -90,7 +153,7 @@ def main():
 if __name__ == '__main__':
     print("Starting download...")
     time_start = time.time()
-    main()
+    asyncio.run(main())
     time_end = time.time()
     time_elapsed_seconds = time_end - time_start
     print("Downloaded in %d minutes and %.2f seconds." % (time_elapsed_seconds // 60, time_elapsed_seconds % 60),)
\ No newline at end of file
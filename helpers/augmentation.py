@@ -7,7 +7,39 @@ import numpy as np
 import imgaug as ia
 from imgaug.augmentables.bbs import BoundingBox, BoundingBoxesOnImage
 from imgaug import augmenters as iaa
-import imageio
+from numba import njit
+
+from helpers.files import write_file
+
+# Layout of a single YOLO data file line.
+yolo_line_format = "%d %.6f %.6f %.6f %.6f\n"
+
+@njit(cache=True, fastmath=True)
+def _yolo_to_pixel(boxes, image_width, image_height):
+    # Normalized (left, top, width, height) rows to pixel (x1, y1, x2, y2) rows.
+    pixels = np.empty_like(boxes)
+    for i in range(boxes.shape[0]):
+        pixels[i, 0] = boxes[i, 0] * image_width
+        pixels[i, 1] = boxes[i, 1] * image_height
+        pixels[i, 2] = (boxes[i, 0] + boxes[i, 2]) * image_width
+        pixels[i, 3] = (boxes[i, 1] + boxes[i, 3]) * image_height
+    return pixels
+
+@njit(cache=True, fastmath=True)
+def _pixel_to_yolo(pixels, image_width, image_height):
+    # Pixel (x1, y1, x2, y2) rows to normalized (left, top, width, height) rows.
+    # Corners are rounded to whole pixels first, matching BoundingBox.x1_int etc.
+    boxes = np.empty_like(pixels)
+    for i in range(pixels.shape[0]):
+        x1 = np.rint(pixels[i, 0])
+        y1 = np.rint(pixels[i, 1])
+        x2 = np.rint(pixels[i, 2])
+        y2 = np.rint(pixels[i, 3])
+        boxes[i, 0] = x1 / image_width
+        boxes[i, 1] = y1 / image_height
+        boxes[i, 2] = (x2 - x1) / image_width
+        boxes[i, 3] = (y2 - y1) / image_height
+    return boxes
 
 class Augment:
     """
@@ -23,13 +55,25 @@ class Augment:
     num_repetitions : int, optional
         The number of times `operation` will be applied, by default 1. Good for
         when you have a lot of randomness and need multiple passes.
+    grayscale : bool, optional
+        Whether `operation` should receive grayscale images, by default False.
+        Images are converted once up front to single channel uint8 and shared
+        by every grayscale `Augment`, so `operation` doesn't need its own
+        `iaa.Grayscale` step. The results are saved as grayscale images.
+    gpu_operation : kornia.augmentation.AugmentationSequential, optional
+        Equivalent of `operation` to run on the GPU when augment.py is run with
+        `--gpu`, by default None. See helpers/gpu.py.
     """
-    def __init__(self, name, operation, num_repetitions=1):
+    def __init__(self, name, operation, num_repetitions=1, grayscale=False, gpu_operation=None):
         self.name = name
         self.operation = operation
         self.num_repetitions = num_repetitions
+        self.grayscale = grayscale
+        self.gpu_operation = gpu_operation
 
 class ImageDataRegion:
+    __slots__ = ("tag_name", "left", "top", "width", "height")
+
     def __init__(self, tag_name, left, top, width, height):
         """
         Represents a tagged region of an image.
@@ -72,19 +116,36 @@ class ImageDataRegion:
             label=self.tag_name)
 
 class ImageData:
-    def __init__(self):
+    def __init__(self, tag_names=None, boxes=None):
         """
         Holds framework-independent data about an image's tagged regions.
+
+        Regions are stored column-wise: `tag_names` holds each region's name
+        and `boxes` is a float64 array of normalized (left, top, width, height)
+        rows in the same order.
         """
-        self.regions = []
-    
+        self.tag_names = [] if tag_names is None else tag_names
+        self.boxes = np.empty((0, 4), dtype=np.float64) if boxes is None else boxes
+
+    @property
+    def regions(self):
+        """
+        Regions as a list of ImageDataRegions, built on access from
+        `tag_names` and `boxes`. Kept for backward compatibility with code
+        that works with one object per region; editing the list or its
+        regions doesn't change the ImageData.
+        """
+        return [ImageDataRegion(tag_name, *box) for tag_name, box in zip(self.tag_names, self.boxes.tolist())]
+
     def add_region(self, tag_name, left, top, width, height):
-        self.regions.append(ImageDataRegion(tag_name, left, top, width, height))
+        # Copies `boxes` on every call, prefer building ImageData from columns
+        self.tag_names.append(tag_name)
+        self.boxes = np.vstack((self.boxes, (left, top, width, height)))
 
     @staticmethod
     def from_yolo_data(data_path, class_names):
         """
-        Populate ImageDataRegions from data file using known YOLO format.
+        Populate ImageData from data file using known YOLO format.
         
         Format is `<object-class> <x-center> <y-center> <width> <height>`, 
         with all numbers normalized between 0 and 1.
@@ -101,32 +162,32 @@ class ImageData:
         ImageData
             ImageData populated from YOLO data.
         """
-        data = ImageData()
-
-        # Construct regions
-        data_lines = []
+        # Parse every row at once. Empty data files hold no regions.
         with open(data_path) as data_file:
-            data_lines = [line.rstrip() for line in data_file if line.rstrip() != ""]
+            rows = np.array(data_file.read().split(), dtype=np.float64).reshape(-1, 5)
 
-        for line in data_lines:
-            elements = line.split(" ")
-            tag_index = int(elements[0])
-            tag_name = class_names[tag_index]
-            center_x, center_y, width, height = [float(x) for x in elements[1:]]
-            data.add_region(tag_name, center_x - (width / 2), center_y - (height / 2), width, height)
+        # Convert centers to top-left origins
+        boxes = rows[:, 1:].copy()
+        boxes[:, :2] -= boxes[:, 2:] / 2
 
-        return data
+        tag_names = [class_names[tag_index] for tag_index in rows[:, 0].astype(np.int32).tolist()]
+        return ImageData(tag_names, boxes)
 
     def to_imgaug(self, image_shape):
         """
-        Get imgaug.BoundingBoxesOnImage from ImageDataRegions.
+        Get imgaug.BoundingBoxesOnImage from the image's regions.
         """
         image_height, image_width, _ = image_shape
 
-        # Create ia bounding boxes from json
-        regions = []
-        for region in self.regions:
-            regions.append(region.to_imgaug(image_width, image_height))
+        # Convert all regions to pixel coordinates at once
+        pixels = _yolo_to_pixel(self.boxes, image_width, image_height)
+
+        # Create ia bounding boxes. tolist() unpacks all rows in one call
+        # instead of creating a numpy scalar per coordinate.
+        regions = [
+            BoundingBox(x1=x1, y1=y1, x2=x2, y2=y2, label=tag_name)
+            for tag_name, (x1, y1, x2, y2) in zip(self.tag_names, pixels.tolist())
+        ]
         bbs = BoundingBoxesOnImage(regions, shape=image_shape)
 
         return bbs
@@ -151,14 +212,38 @@ class ImageData:
             ImageData populated from imgaug data.
         """
 
-        data = ImageData()
-        for bb in imgaug_bounding_boxes:
-            # Convert from imgaug bounding boxes to ImageDataRegion
-            data.regions.append(ImageDataRegion.from_imgaug(bb, image_width, image_height))
+        # Convert all imgaug bounding boxes to normalized coordinates at once
+        pixels = np.array([(bb.x1, bb.y1, bb.x2, bb.y2) for bb in imgaug_bounding_boxes], dtype=np.float64).reshape(-1, 4)
+        boxes = _pixel_to_yolo(pixels, image_width, image_height)
 
-        return data
+        return ImageData([bb.label for bb in imgaug_bounding_boxes], boxes)
 
-    def write_yolo(self, data_path, class_names):
+    def to_yolo(self, class_to_id):
+        """
+        Format image data as the contents of a YOLO data file.
+
+        Parameters
+        ----------
+        class_to_id : {string: int}
+            Mapping from region class name to its index in the class name list.
+
+        Returns
+        -------
+        bytes
+            YOLO data file contents.
+        """
+        # Construct YOLO rows (format is "<object-class> <x-center> <y-center> <width> <height>", all numbers normalized between 0 and 1)
+        # Centers and sizes are computed for all rows at once, then unpacked
+        # into plain floats in one call so formatting skips numpy scalars.
+        columns = np.empty_like(self.boxes)
+        columns[:, :2] = self.boxes[:, :2] + (self.boxes[:, 2:] / 2)
+        columns[:, 2:] = self.boxes[:, 2:]
+        return "".join([
+            yolo_line_format % (class_to_id[tag_name], *row)
+            for tag_name, row in zip(self.tag_names, columns.tolist())
+        ]).encode("ascii")
+
+    def write_yolo(self, data_path, class_to_id):
         """
         Write image data as YOLO formatted data file.
 
@@ -166,13 +251,7 @@ class ImageData:
         ----------
         data_path : string
             Path for new data file.
-        class_names : [string]
-            Region class name list.
-        """
-        with open(data_path, "w+") as data_file:
-            lines = []
-            for region in self.regions:
-                # Construct YOLO line (format is "<object-class> <x-center> <y-center> <width> <height>", all numbers normalized between 0 and 1)
-                line = f"{class_names.index(region.tag_name)} {region.left + (region.width / 2)} {region.top + (region.height / 2)} {region.width} {region.height}"
-                lines.append(line)
-            data_file.write("\n".join(lines))
\ No newline at end of file
+        class_to_id : {string: int}
+            Mapping from region class name to its index in the class name list.
+        """
+        write_file(data_path, self.to_yolo(class_to_id))
@@ -0,0 +1,169 @@
+import numpy as np
+import cv2
+from numba import njit, prange
+from imgaug import augmenters as iaa
+
+"""
+Drop-in replacements for imgaug augmenters that call straight into
+OpenCV or Numba kernels. Image functions are implemented as classes
+rather than closures so that augmenters stay picklable for imgaug's
+multiprocessing pool.
+"""
+
+def _restore_channel_axis(result, image):
+    # OpenCV drops a trailing single channel axis, imgaug expects it kept.
+    if result.ndim == 2 and image.ndim == 3:
+        return result[:, :, None]
+    return result
+
+class _OpenCVGaussianBlurImages:
+    def __init__(self, sigma):
+        self.sigma = sigma
+
+    def __call__(self, images, random_state, parents, hooks):
+        low, high = self.sigma
+        return [
+            _restore_channel_axis(cv2.GaussianBlur(image, (0, 0), sigmaX=random_state.uniform(low, high)), image)
+            for image in images
+        ]
+
+def opencv_gaussian_blur(sigma=(3.0, 5.0)):
+    """
+    Gaussian blur computed with `cv2.GaussianBlur`, equivalent to `iaa.GaussianBlur`.
+
+    Bounding boxes are left untouched since blurring doesn't move anything.
+
+    Parameters
+    ----------
+    sigma : (float, float), optional
+        Range that the blur sigma is sampled from for each image, by default (3.0, 5.0).
+
+    Returns
+    -------
+    imgaug.augmenters.Lambda
+        Augmenter that blurs each image.
+    """
+    return iaa.Lambda(func_images=_OpenCVGaussianBlurImages(sigma))
+
+class _OpenCVFixedRotation:
+    def __init__(self, angle):
+        self.angle = angle
+        # Rotation matrices keyed by (height, width) of the image
+        self.matrices = {}
+
+    def _get_matrices(self, height, width):
+        matrices = self.matrices.get((height, width))
+        if matrices is None:
+            # imgaug rotates clockwise for positive angles, OpenCV counterclockwise.
+            # Pixel indices and imgaug keypoint coordinates are offset by half a
+            # pixel, so each gets a matrix around its own notion of the center.
+            image_matrix = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), -self.angle, 1.0)
+            keypoint_matrix = cv2.getRotationMatrix2D((width / 2, height / 2), -self.angle, 1.0)
+            matrices = (image_matrix, keypoint_matrix)
+            self.matrices[(height, width)] = matrices
+        return matrices
+
+    def images(self, images, random_state, parents, hooks):
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            image_matrix, _ = self._get_matrices(height, width)
+            result = cv2.warpAffine(image, image_matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            results.append(_restore_channel_axis(result, image))
+        return results
+
+    def keypoints(self, keypoints_on_images, random_state, parents, hooks):
+        for keypoints_on_image in keypoints_on_images:
+            height, width = keypoints_on_image.shape[:2]
+            _, keypoint_matrix = self._get_matrices(height, width)
+            # Transform all points of the image with one matrix multiply
+            xy = keypoints_on_image.to_xy_array()
+            keypoints_on_image.fill_from_xy_array_(xy @ keypoint_matrix[:, :2].T + keypoint_matrix[:, 2])
+        return keypoints_on_images
+
+def opencv_rotate(angle):
+    """
+    Rotation by a fixed angle computed with `cv2.warpAffine`, equivalent to `iaa.Rotate(angle)`.
+
+    The rotation matrix is computed once per image size and reused. Bounding
+    boxes are rotated through their corner points, like imgaug does.
+
+    Parameters
+    ----------
+    angle : float
+        Clockwise rotation in degrees.
+
+    Returns
+    -------
+    imgaug.augmenters.Lambda
+        Augmenter that rotates each image.
+    """
+    rotation = _OpenCVFixedRotation(angle)
+    return iaa.Lambda(func_images=rotation.images, func_keypoints=rotation.keypoints)
+
+# Whether image functions use their multithreaded Numba kernels. Turned off
+# in worker processes that already run one per core.
+_parallel_kernels = True
+
+def use_serial_kernels():
+    """
+    Switch image functions to their single-threaded Numba kernels. Call this
+    in pool worker processes so each worker doesn't start its own full set
+    of Numba threads on top of the other workers.
+    """
+    global _parallel_kernels
+    _parallel_kernels = False
+
+def _add_gaussian_noise_uint8_kernel(image, scale, seed):
+    # Add N(0, scale) noise to a (height, width, channels) uint8 image in a
+    # single pass, saturating at 0 and 255. Like iaa.AdditiveGaussianNoise
+    # with per_channel=False, each pixel gets one noise value for all of its
+    # channels. Every row is seeded separately so results don't depend on
+    # how rows are split across threads.
+    height, width, channels = image.shape
+    result = np.empty_like(image)
+    for y in prange(height):
+        np.random.seed(seed + y)
+        for x in range(width):
+            noise = np.random.normal(0.0, scale)
+            for c in range(channels):
+                value = np.rint(image[y, x, c] + noise)
+                if value < 0.0:
+                    value = 0.0
+                elif value > 255.0:
+                    value = 255.0
+                result[y, x, c] = np.uint8(value)
+    return result
+
+_add_gaussian_noise_uint8 = njit(parallel=True, fastmath=True, cache=True)(_add_gaussian_noise_uint8_kernel)
+# prange runs as a plain range when compiled without parallel=True
+_add_gaussian_noise_uint8_serial = njit(fastmath=True, cache=True)(_add_gaussian_noise_uint8_kernel)
+
+class _NumbaAdditiveGaussianNoiseImages:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, images, random_state, parents, hooks):
+        kernel = _add_gaussian_noise_uint8 if _parallel_kernels else _add_gaussian_noise_uint8_serial
+        return [
+            kernel(image, self.scale, random_state.integers(0, 2**30))
+            for image in images
+        ]
+
+def numba_additive_gaussian_noise(scale):
+    """
+    Gaussian noise computed with a parallel Numba kernel, equivalent to
+    `iaa.AdditiveGaussianNoise(scale=scale)` for uint8 images. The kernel is
+    single-threaded after `use_serial_kernels()`, with the same results.
+
+    Parameters
+    ----------
+    scale : float
+        Standard deviation of the noise, in pixel intensity units.
+
+    Returns
+    -------
+    imgaug.augmenters.Lambda
+        Augmenter that adds noise to each image.
+    """
+    return iaa.Lambda(func_images=_NumbaAdditiveGaussianNoiseImages(scale))
@@ -0,0 +1,198 @@
+import os
+import io
+import queue
+import threading
+from shutil import copyfile
+
+import numpy as np
+from PIL import Image
+
+# JPEG quality used when writing augmented images.
+jpeg_quality = 92
+
+def read_image(image_path):
+    """
+    Load an image from disk as an RGB uint8 array.
+
+    Decoding goes through Pillow, so installing pillow-simd in place of
+    pillow speeds this up without any code changes.
+
+    Parameters
+    ----------
+    image_path : string
+        Path to the image file.
+
+    Returns
+    -------
+    numpy.ndarray
+        Contiguous uint8 array of shape (height, width, 3).
+    """
+    with Image.open(image_path) as image:
+        return np.asarray(image.convert("RGB"))
+
+def encode_image(image, extension):
+    """
+    Encode a uint8 image array in memory.
+
+    Single channel images are encoded as grayscale.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        uint8 array of shape (height, width, 3) or (height, width, 1).
+    extension : string
+        File extension that picks the format, e.g. ".jpg".
+
+    Returns
+    -------
+    bytes
+        Encoded image file contents.
+    """
+    if image.shape[2] == 1:
+        image = image[:, :, 0]
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format=Image.registered_extensions()[extension.lower()], quality=jpeg_quality)
+    return buffer.getvalue()
+
+def write_file(path, payload):
+    """
+    Write bytes to a file with raw `os.write` calls, skipping Python's buffered file layer.
+
+    Parameters
+    ----------
+    path : string
+        Path of the file to create or replace. An existing file is unlinked
+        rather than truncated, so a hardlink left by `mirror_file` never
+        carries the write through to the mirrored source.
+    payload : bytes
+        File contents.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+class FileFlusher:
+    """
+    Writes files from a single background thread.
+
+    Producers hand over already-encoded payloads with `put()`. The flusher
+    thread drains up to `flush_batch_size` of them at a time and writes each
+    with one `os.write`, so file creation stays off the producer threads.
+
+    Parameters
+    ----------
+    max_pending : int, optional
+        Maximum number of payloads waiting to be written before `put()` blocks, by default 256.
+    flush_batch_size : int, optional
+        Maximum number of payloads written per pass, by default 64.
+    """
+    def __init__(self, max_pending=256, flush_batch_size=64):
+        self.flush_batch_size = flush_batch_size
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, path, payload):
+        """
+        Queue `payload` to be written to `path`.
+        """
+        self._queue.put((path, payload))
+
+    def close(self):
+        """
+        Write everything still queued and stop the thread. Raises the first
+        error hit while writing, if any.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.flush_batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in items:
+                if item is None:
+                    return
+                # After an error keep draining so producers never block.
+                if self.error is not None:
+                    continue
+                try:
+                    write_file(*item)
+                except Exception as e:
+                    self.error = e
+
+def _kernel_copy(source_path, destination_path, copy_chunk):
+    # Copy a file with a syscall that moves bytes inside the kernel.
+    # `copy_chunk(source_fd, destination_fd, offset, count)` returns the
+    # number of bytes it copied.
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        remaining = os.fstat(source.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            copied = copy_chunk(source.fileno(), destination.fileno(), offset, remaining)
+            if copied == 0:
+                break
+            offset += copied
+            remaining -= copied
+    return remaining == 0
+
+def mirror_file(source_path, destination_path):
+    """
+    Place a copy of a file at the destination without copying bytes where possible.
+
+    Tries a hardlink first, then kernel-side copies (`copy_file_range`, which
+    reflinks on copy-on-write filesystems, then `sendfile`), and falls back to
+    a regular copy.
+
+    Parameters
+    ----------
+    source_path : string
+        Path to the file to mirror.
+    destination_path : string
+        Path for the mirrored file. Replaced if it already exists.
+    """
+    # Remove any existing destination first. It may be a hardlink to the
+    # source from a previous run, and writing through it would truncate
+    # the source.
+    try:
+        os.unlink(destination_path)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(source_path, destination_path)
+        return
+    except OSError:
+        pass
+
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(lambda source, destination, offset, count: os.copy_file_range(source, destination, count))
+    if hasattr(os, "sendfile"):
+        # Only works for regular file destinations on Linux. macOS raises OSError.
+        kernel_copies.append(lambda source, destination, offset, count: os.sendfile(destination, source, offset, count))
+
+    for copy_chunk in kernel_copies:
+        try:
+            if _kernel_copy(source_path, destination_path, copy_chunk):
+                return
+        except OSError:
+            pass
+
+    copyfile(source_path, destination_path)
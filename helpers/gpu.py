@@ -0,0 +1,104 @@
+import numpy as np
+from imgaug.augmentables.bbs import BoundingBox, BoundingBoxesOnImage
+
+"""
+Optional GPU augmentation through kornia. Install the extra dependencies
+with `poetry install -E gpu`. Everything here degrades to "no GPU" when
+torch or kornia aren't installed, so MyAugments.py can always import it.
+"""
+
+try:
+    import torch
+    import kornia.augmentation as K
+except ImportError:
+    torch = None
+    K = None
+
+device = "cuda"
+
+def is_gpu_available():
+    """
+    Whether GPU augmentation can be used on this machine.
+    """
+    return torch is not None and torch.cuda.is_available()
+
+def seed(value):
+    """
+    Seed the random number generator used by kornia augmentations.
+    """
+    if torch is not None:
+        torch.manual_seed(value)
+
+def gpu_gaussian_blur(sigma=(3.0, 5.0)):
+    """
+    kornia equivalent of `iaa.GaussianBlur(sigma=sigma)`, or None when kornia isn't installed.
+    """
+    if K is None:
+        return None
+    # kornia >= 0.6.12 samples one sigma per image from the `sigma` range and
+    # uses it on both axes, like the CPU op. Kernel wide enough to cover 3
+    # sigma on either side.
+    kernel_size = 2 * int(np.ceil(3 * sigma[1])) + 1
+    return K.AugmentationSequential(
+        K.RandomGaussianBlur((kernel_size, kernel_size), sigma, p=1.0),
+        data_keys=["input", "bbox_xyxy"])
+
+def gpu_affine(scale=(1.0, 1.0), rotate=(0, 0)):
+    """
+    kornia equivalent of `iaa.Affine(scale={"x": scale, "y": scale}, rotate=rotate)`,
+    or None when kornia isn't installed.
+    """
+    if K is None:
+        return None
+    return K.AugmentationSequential(
+        K.RandomAffine(degrees=rotate, scale=(scale[0], scale[1], scale[0], scale[1]), p=1.0),
+        data_keys=["input", "bbox_xyxy"])
+
+def _to_device(array):
+    tensor = torch.from_numpy(array)
+    if torch.device(device).type == "cuda":
+        # Pinned memory lets the host to device copy run asynchronously
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
+
+def augment_on_gpu(gpu_operation, images, bounding_boxes):
+    """
+    Apply a kornia augmentation to a batch of images and their bounding boxes.
+
+    Parameters
+    ----------
+    gpu_operation : kornia.augmentation.AugmentationSequential
+        Augmentation taking images and `bbox_xyxy` boxes.
+    images : numpy.ndarray
+        uint8 array of shape (batch size, height, width, channels).
+    bounding_boxes : [imgaug.BoundingBoxesOnImage]
+        Bounding boxes for each image.
+
+    Returns
+    -------
+    (numpy.ndarray, [imgaug.BoundingBoxesOnImage])
+        Augmented images, in the same layout as `images`, and their bounding boxes.
+    """
+    # Boxes are padded to the same count per image to fit in one tensor
+    max_box_count = max([1] + [len(bbs.bounding_boxes) for bbs in bounding_boxes])
+    boxes = np.zeros((len(bounding_boxes), max_box_count, 4), dtype=np.float32)
+    for index, bbs in enumerate(bounding_boxes):
+        if len(bbs.bounding_boxes) > 0:
+            boxes[index, :len(bbs.bounding_boxes)] = bbs.to_xyxy_array()
+
+    gpu_operation = gpu_operation.to(device)
+    images_tensor = _to_device(images).permute(0, 3, 1, 2).contiguous().float().div_(255)
+    boxes_tensor = _to_device(boxes)
+    with torch.no_grad():
+        images_tensor, boxes_tensor = gpu_operation(images_tensor, boxes_tensor)
+
+    images_aug = images_tensor.mul_(255).round_().clamp_(0, 255).byte().permute(0, 2, 3, 1).contiguous().cpu().numpy()
+    boxes_aug = boxes_tensor.cpu().numpy()
+
+    bounding_boxes_aug = []
+    for index, bbs in enumerate(bounding_boxes):
+        bounding_boxes_aug.append(BoundingBoxesOnImage([
+            BoundingBox(x1=x1, y1=y1, x2=x2, y2=y2, label=bb.label)
+            for bb, (x1, y1, x2, y2) in zip(bbs.bounding_boxes, boxes_aug[index])
+        ], shape=images_aug[index].shape))
+    return images_aug, bounding_boxes_aug
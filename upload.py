@@ -6,6 +6,9 @@ import os
 import math
 from pathlib import Path
 import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Dependency imports
 from tqdm import tqdm
@@ -14,7 +17,7 @@ from azure.cognitiveservices.vision.customvision.training.models import ImageFil
 from msrest.authentication import ApiKeyCredentials
 
 # Local imports
-from helpers.augmentation import ImageData, ImageDataRegion
+from helpers.augmentation import ImageData
 
 # Hard limit imposed by Custom Vision's API. 
 # See docs for `create_images_from_files`
@@ -24,23 +27,23 @@ max_upload_batch_size = 64
 superfluous_tag_name = "coreml_bugfix"
 num_images_tagged_with_superfluous_tag = 15  # Minimum required by Custom Vision
 
-def image_data_region_to_custom_vision_region(region, map_tag_name_to_id):
-    tag_id = map_tag_name_to_id.get(region.tag_name)
-    if tag_id == None:
-        raise Exception(f"No Custom Vision tag ID found for locally-defined region with tag name \"{region.tag_name}\".")
-    return Region(
-        tag_id=tag_id,
-        left=region.left,
-        top=region.top,
-        width=region.width,
-        height=region.height)
-
-def image_data_to_custom_vision_create_entry(image_data, image_path, map_tag_name_to_id):
-    image_file = open(image_path, mode="rb")
-    custom_vision_regions = [image_data_region_to_custom_vision_region(region, map_tag_name_to_id) for region in image_data.regions]
-    create_entry = ImageFileCreateEntry(name=Path(image_path).name, contents=image_file.read(), regions=custom_vision_regions)
-    image_file.close()
-    return create_entry
+# Threads used to read YOLO data files from disk.
+max_load_threads = 32
+# Threads used to read a batch's image files while the previous batch uploads.
+max_read_threads = 16
+# Batches uploaded at the same time. Kept small to stay under Custom Vision's rate limit.
+max_inflight_uploads = 4
+# Threads used to register tags with Custom Vision.
+max_tag_threads = 16
+
+def image_data_to_custom_vision_create_entry(image_data, image_path, image_name, map_tag_name_to_id):
+    # Build regions straight from the ImageData columns. Tag names are
+    # checked against `map_tag_name_to_id` once per upload, not per region.
+    custom_vision_regions = [
+        Region(tag_id=map_tag_name_to_id[tag_name], left=left, top=top, width=width, height=height)
+        for tag_name, (left, top, width, height) in zip(image_data.tag_names, image_data.boxes.tolist())
+    ]
+    return ImageFileCreateEntry(name=image_name, contents=Path(image_path).read_bytes(), regions=custom_vision_regions)
 
 class LocalData:
     """
@@ -55,6 +58,7 @@ class LocalData:
     def __init__(self):
         self.image_data = []
         self.image_paths = []
+        self.image_names = []
         self.data_paths = []
         self.tags = []
 
@@ -68,16 +72,16 @@ class LocalData:
             class_names = [line.rstrip() for line in class_file if line.rstrip() != ""]
         data.tags = class_names
 
-        # Populate from txt files in directory.
-        data_filenames = [x for x in os.listdir(base_directory) if x.endswith(".txt")]
-        for data_filename in data_filenames:
-            data_path = os.path.join(base_directory, data_filename)
-            data.data_paths.append(data_path)
+        # Populate from txt files in directory. DirEntry already carries the full path.
+        entries = sorted((entry for entry in os.scandir(base_directory) if entry.name.endswith(".txt")), key=lambda entry: entry.name)
+        data_paths = [entry.path for entry in entries]
+        data.data_paths = data_paths
+        data.image_paths = [data_path[:-len(".txt")] + ".jpg" for data_path in data_paths]
+        data.image_names = [entry.name[:-len(".txt")] + ".jpg" for entry in entries]
 
-            image_data = ImageData.from_yolo_data(data_path, class_names)
-            data.image_data.append(image_data)
-
-            data.image_paths.append(os.path.join(base_directory, data_filename.replace(".txt", ".jpg")))
+        # Parse data files on a thread pool so file reads overlap. map keeps the sorted order.
+        with ThreadPoolExecutor(max_workers=max_load_threads) as executor:
+            data.image_data = list(executor.map(lambda data_path: ImageData.from_yolo_data(data_path, class_names), data_paths))
 
         return data
 
@@ -106,7 +110,18 @@ def main():
     
     # Prepare for Custom Vision upload
     credentials = ApiKeyCredentials(in_headers={"Training-key": training_key})
-    trainer = CustomVisionTrainingClient(endpoint, credentials)
+
+    # Batches upload from several threads, and each thread gets its own
+    # client since msrest clients aren't documented as thread safe.
+    thread_local = threading.local()
+
+    def get_thread_trainer():
+        if not hasattr(thread_local, "trainer"):
+            thread_local.trainer = CustomVisionTrainingClient(endpoint, credentials)
+            # Without keep_alive msrest closes its requests session after every
+            # call, so each request would open a new HTTPS connection.
+            thread_local.trainer.config.keep_alive = True
+        return thread_local.trainer
 
     def add_superfluous_region_to_regions(regions, map_tag_name_to_id):
         tag_id = map_tag_name_to_id.get(superfluous_tag_name)
@@ -124,17 +139,21 @@ def main():
         Register local region tag names with Custom Vision and return 
         corresponding Custom Vision tag objects from the server.
         """
-        for tag_name in tag_names:
+        def register_tag_name(tag_name):
             try:
-                trainer.create_tag(project_id=project_id, name=tag_name)
+                get_thread_trainer().create_tag(project_id=project_id, name=tag_name)
             except CustomVisionErrorException as e:
                 # If a tag with the given name already exists server-side, create_tag 
                 # throws an exception. We ignore this behavior, since we only care 
                 # about creating it if it isn't already registered.
                 print(f"Exception: {e}")
 
+        # Create tags in parallel, since each one is a separate request
+        with ThreadPoolExecutor(max_workers=max_tag_threads) as executor:
+            list(executor.map(register_tag_name, tag_names))
+
         # Fetch all tags from the server
-        package_tags = trainer.get_tags(project_id=project_id)
+        package_tags = get_thread_trainer().get_tags(project_id=project_id)
         return package_tags
 
     def process_batch(images):
@@ -143,7 +162,7 @@ def main():
         """
         batch = ImageFileCreateBatch(images=images)
         # Limited to 64 images and 20 tags per batch.
-        upload_result = trainer.create_images_from_files(project_id=project_id, batch=batch)
+        upload_result = get_thread_trainer().create_images_from_files(project_id=project_id, batch=batch)
 
         num_duplicates = 0
         error_results = []
@@ -173,9 +192,10 @@ def main():
         """
 
         # Register tags with Custom Vision
-        tags_to_register = local_data.tags
+        # Deduplicated, keeping order. Built fresh so local_data.tags isn't modified.
+        tags_to_register = dict.fromkeys(local_data.tags)
         if add_superfluous_regions:
-            tags_to_register.append(superfluous_tag_name)
+            tags_to_register[superfluous_tag_name] = None
         custom_vision_tags = register_tag_names(tags_to_register)
     
         # Construct a mapping from local tag name to Custom Vision tag ID.
@@ -183,18 +203,18 @@ def main():
         for tag in custom_vision_tags:
             map_tag_name_to_id[tag.name] = tag.id
 
-        total_batch_count = math.ceil(len(local_data.image_data) / max_upload_batch_size)
-        current_batch_index = 0
-        print(f"There will be {total_batch_count} batches uploaded ({len(local_data.image_data)} images in total).")
+        # Every region's tag comes from local_data.tags, so checking those up front covers all regions.
+        for tag_name in tags_to_register:
+            if tag_name not in map_tag_name_to_id:
+                raise Exception(f"No Custom Vision tag ID found for locally-defined region with tag name \"{tag_name}\".")
 
-        custom_vision_data_batch = []
+        image_count = len(local_data.image_data)
+        total_batch_count = math.ceil(image_count / max_upload_batch_size)
+        print(f"There will be {total_batch_count} batches uploaded ({image_count} images in total).")
 
-        progress_bar = tqdm(total=total_batch_count)
-
-        # For each data file, convert the image file and region information 
-        # to Custom Vision objects and upload them in batches.
-        for i, (data, image_path) in enumerate(zip(local_data.image_data, local_data.image_paths)):
-            custom_vision_data = image_data_to_custom_vision_create_entry(data, image_path, map_tag_name_to_id)  # Loads image and backing data into memory
+        def build_entry(i):
+            # Loads image and backing data into memory
+            custom_vision_data = image_data_to_custom_vision_create_entry(local_data.image_data[i], local_data.image_paths[i], local_data.image_names[i], map_tag_name_to_id)
             if add_superfluous_regions and i < num_images_tagged_with_superfluous_tag:
                 """
                 If the --add_superfluous_regions flag is set, then the first
@@ -204,18 +224,39 @@ def main():
                 to need at least two tags to function.
                 """
                 add_superfluous_region_to_regions(custom_vision_data.regions, map_tag_name_to_id)
-            custom_vision_data_batch.append(custom_vision_data)
-            
-            # Upload the batch if we've hit the max batch size or the last data file.
-            if len(custom_vision_data_batch) == max_upload_batch_size or i == len(local_data.image_data) - 1:
-                # print(f"Uploading batch {current_batch_index + 1} of {total_batch_count}...")
-                try:
-                    process_batch(custom_vision_data_batch)
-                except Exception as e:
-                    print(f"Exception: {e}")
-                custom_vision_data_batch.clear()
-                current_batch_index += 1
-                progress_bar.update(1)
+            return custom_vision_data
+
+        def build_batch(batch_index):
+            # Read the batch's image files in parallel, keeping their order.
+            batch_start = batch_index * max_upload_batch_size
+            return list(read_executor.map(build_entry, range(batch_start, min(batch_start + max_upload_batch_size, image_count))))
+
+        progress_bar = tqdm(total=total_batch_count)
+
+        def upload_batch(custom_vision_data_batch):
+            try:
+                process_batch(custom_vision_data_batch)
+            except Exception as e:
+                print(f"Exception: {e}")
+            progress_bar.update(1)
+
+        # For each data file, convert the image file and region information 
+        # to Custom Vision objects and upload them in batches. The next batch
+        # is read from disk while up to `max_inflight_uploads` batches upload.
+        with ThreadPoolExecutor(max_workers=1) as prefetch_executor, \
+                ThreadPoolExecutor(max_workers=max_read_threads) as read_executor, \
+                ThreadPoolExecutor(max_workers=max_inflight_uploads) as upload_executor:
+            next_batch = prefetch_executor.submit(build_batch, 0) if total_batch_count > 0 else None
+            inflight_uploads = deque()
+            for batch_index in range(total_batch_count):
+                custom_vision_data_batch = next_batch.result()
+                if batch_index + 1 < total_batch_count:
+                    next_batch = prefetch_executor.submit(build_batch, batch_index + 1)
+
+                # print(f"Uploading batch {batch_index + 1} of {total_batch_count}...")
+                inflight_uploads.append(upload_executor.submit(upload_batch, custom_vision_data_batch))
+                if len(inflight_uploads) >= max_inflight_uploads:
+                    inflight_uploads.popleft().result()
         
         progress_bar.close()
 